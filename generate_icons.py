@@ -37,10 +37,14 @@ def create_icon(size: int) -> Image.Image:
 def main():
     sizes = [16, 32, 48, 128]
     
+    # Draw once at high resolution and downscale, which antialiases far
+    # better than drawing directly at small sizes
+    master = create_icon(512)
+    
     for size in sizes:
-        icon = create_icon(size)
+        icon = master.resize((size, size), Image.LANCZOS)
         filename = f"extension/icons/icon{size}.png"
-        icon.save(filename, 'PNG')
+        icon.save(filename, 'PNG', optimize=True)
         print(f"Created {filename}")
     
     print("Icons generated successfully!")
@@ -0,0 +1,13 @@
+"""Gunicorn settings, read automatically when gunicorn runs in this directory."""
+
+bind = '0.0.0.0:5050'
+# Each worker starts its own model process
+workers = 1
+worker_class = 'gthread'
+threads = 8
+
+
+def post_worker_init(worker):
+    """Start loading the model once the worker has imported the app."""
+    import server
+    server.start_background_work()
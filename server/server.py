@@ -5,51 +5,219 @@ A Flask server that uses Pocket TTS to convert text to speech.
 Supports streaming audio and multiple voices.
 """
 
-import io
+import atexit
+import hashlib
+import itertools
+import logging
+import multiprocessing as mp
+import queue
 import re
-import wave
-from flask import Flask, request, jsonify, Response
-from flask_cors import CORS
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.shared_memory import SharedMemory
+from flask import Flask, request, Response, stream_with_context
+from flask_compress import Compress
 import numpy as np
+import orjson
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for Chrome extension
+# Reject oversized bodies before reading them; articles are well under this
+app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024
 
-# Global model instance (lazy loaded)
+# Compress JSON responses such as long paragraph lists; audio streams are left alone
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+
+log = logging.getLogger('pocket_reader')
+
+
+def _setup_logging():
+    """Log through a queue, so writing to stdout happens off request threads."""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    log.addHandler(QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+
+_setup_logging()
+
+# Global model instance (lazy loaded, only inside the model worker process)
 _tts_model = None
-_voice_states = {}
+_model_lock = threading.Lock()
+
+# Loaded voice states, least recently used first
+_voice_states = OrderedDict()
+_voice_lock = threading.Lock()
+
+# Synthesized PCM16 audio keyed by voice and text digest, least recently used first
+_audio_cache = OrderedDict()
+_audio_cache_bytes = 0
+_audio_cache_lock = threading.Lock()
+
+# Model worker process and the reply queues of requests it hasn't finished
+_worker_process = None
+_worker_lock = threading.Lock()
+_request_queue = None
+_pending_requests = {}
+_request_ids = itertools.count()
+_worker_ready = threading.Event()
+_worker_error = None
+_sample_rate = None
 
 # Available voices (these are the predefined catalog voices)
 AVAILABLE_VOICES = ["alba", "marius", "javert", "jean", "fantine", "cosette", "eponine", "azelma"]
 
+# How many voice states to keep loaded; others are rebuilt on demand
+MAX_LOADED_VOICES = 2
+
+# Limits for the synthesized audio cache
+AUDIO_CACHE_MAX_ENTRIES = 256
+AUDIO_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# Split on double newlines, or single newlines followed by a capitalized line
+_PARA_RE = re.compile(r'\n\s*\n|\n(?=\s*[A-Z])')
+# Whitespace following sentence-ending punctuation
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Only texts up to this length have their paragraph split cached. With 128
+# entries each holding the text and its paragraphs, that bounds the cache to
+# about 13M characters
+SPLIT_CACHE_MAX_CHARS = 50_000
+
+# How long the model worker waits for more requests to join a batch
+BATCH_WAIT_SECONDS = 0.01
+
+# How many paragraphs /synthesize_stream synthesizes ahead of the one being sent
+STREAM_PARAGRAPHS_AHEAD = 2
+
+# How long to wait for the model worker to start, and for each reply from it
+WORKER_START_TIMEOUT_SECONDS = 600
+WORKER_REPLY_TIMEOUT_SECONDS = 300
+
+# Compressed output formats: ffmpeg codec arguments and response mimetype
+ENCODED_FORMATS = {
+    "opus": (["-c:a", "libopus", "-b:a", "32k", "-f", "webm"], "audio/webm"),
+    "mp3": (["-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3"], "audio/mpeg"),
+}
+
+# Compressed formats need ffmpeg; without it responses fall back to WAV
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# Compressed formats the installed ffmpeg can encode, probed on startup
+_encoded_formats = set()
+
 
 def get_model():
     """Lazy load the TTS model."""
     global _tts_model
-    if _tts_model is None:
-        from pocket_tts import TTSModel
-        print("Loading Pocket TTS model...")
-        _tts_model = TTSModel.load_model()
-        print("Model loaded successfully!")
+    with _model_lock:
+        if _tts_model is None:
+            from pocket_tts import TTSModel
+            log.info("Loading Pocket TTS model...")
+            _tts_model = TTSModel.load_model()
+            log.info("Model loaded successfully!")
     return _tts_model
 
 
+def _trim_kv_caches(model_state: dict) -> tuple[dict, dict]:
+    """
+    Slice each attention KV cache in a model state down to its filled length.
+    
+    Voice states are created with caches preallocated for a long generation,
+    of which the voice prompt only fills the start. Returns the trimmed state
+    and, per trimmed cache, its original length and the value its unused tail
+    held, for _expand_kv_caches. Caches that don't look as expected (a
+    'cache' with time on dim 2, a 1-D 'current_end', and a tail holding a
+    single fill value) are kept whole.
+    """
+    trimmed = {}
+    restore = {}
+    for name, state in model_state.items():
+        cache = state.get('cache') if isinstance(state, dict) else None
+        end = state.get('current_end') if isinstance(state, dict) else None
+        if getattr(cache, 'ndim', 0) >= 3 and getattr(end, 'ndim', None) == 1:
+            length = end.shape[0]
+            tail = cache[:, :, length:]
+            if tail.numel() > 0:
+                fill = tail.flatten()[0]
+                uniform = tail.isnan().all() if fill.isnan() else (tail == fill).all()
+                if uniform:
+                    restore[name] = (cache.shape[2], fill.item())
+                    # Clone so the slice doesn't keep the full buffer alive
+                    state = {**state, 'cache': cache[:, :, :length].clone()}
+        trimmed[name] = state
+    return trimmed, restore
+
+
+def _expand_kv_caches(model_state: dict, restore: dict) -> dict:
+    """Pad trimmed KV caches back to their original length for generation."""
+    expanded = dict(model_state)
+    for name, (capacity, fill) in restore.items():
+        state = model_state[name]
+        cache = state['cache']
+        full = cache.new_full((*cache.shape[:2], capacity, *cache.shape[3:]), fill)
+        full[:, :, :cache.shape[2]] = cache
+        expanded[name] = {**state, 'cache': full}
+    return expanded
+
+
 def get_voice_state(voice_name: str):
     """Get or create a voice state for the given voice."""
-    global _voice_states
-    if voice_name not in _voice_states:
-        model = get_model()
-        # Use the voice name directly - pocket_tts handles the predefined voices
-        print(f"Loading voice: {voice_name}...")
-        _voice_states[voice_name] = model.get_state_for_audio_prompt(voice_name)
-        print(f"Voice {voice_name} loaded!")
-    return _voice_states[voice_name]
+    with _voice_lock:
+        if voice_name in _voice_states:
+            _voice_states.move_to_end(voice_name)
+        else:
+            model = get_model()
+            # Use the voice name directly - pocket_tts handles the predefined voices
+            log.info("Loading voice: %s...", voice_name)
+            state = model.get_state_for_audio_prompt(voice_name)
+            # Keep only the filled part of the caches while the voice sits idle
+            _voice_states[voice_name] = _trim_kv_caches(state)
+            log.info("Voice %s loaded!", voice_name)
+            
+            while len(_voice_states) > MAX_LOADED_VOICES:
+                evicted, _ = _voice_states.popitem(last=False)
+                log.info("Unloaded voice: %s", evicted)
+        state, restore = _voice_states[voice_name]
+    return _expand_kv_caches(state, restore)
 
 
 def split_into_paragraphs(text: str) -> list[str]:
     """Split text into paragraphs for chunked processing."""
-    # Split on double newlines, or single newlines followed by whitespace patterns
-    paragraphs = re.split(r'\n\s*\n|\n(?=\s*[A-Z])', text)
+    # Readers often reopen the same article, so recent results are cached
+    if len(text) > SPLIT_CACHE_MAX_CHARS:
+        return _split_text(text)
+    return list(_split_cached(text))
+
+
+@lru_cache(maxsize=128)
+def _split_cached(text: str) -> tuple[str, ...]:
+    """Cached split, returning a tuple so callers can't modify cached results."""
+    return tuple(_split_text(text))
+
+
+def _split_text(text: str) -> list[str]:
+    """Split text into paragraphs, or into sentence groups if it has none."""
+    # Text without newlines is a single paragraph, no need to run the regex
+    if '\n' in text:
+        paragraphs = _PARA_RE.split(text)
+    else:
+        paragraphs = [text]
     
     # Clean up and filter empty paragraphs
     result = []
@@ -60,57 +228,546 @@ def split_into_paragraphs(text: str) -> list[str]:
     
     # If no paragraphs found, split by sentences for very long text
     if len(result) <= 1 and len(text) > 500:
-        # Split into chunks of roughly 2-3 sentences
-        sentences = re.split(r'(?<=[.!?])\s+', text)
+        # Split into chunks of roughly 2-3 sentences, slicing the original text
         result = []
-        current_chunk = []
-        current_length = 0
+        chunk_start = 0
         
-        for sentence in sentences:
-            current_chunk.append(sentence)
-            current_length += len(sentence)
-            
+        for match in _SENT_RE.finditer(text):
             # Aim for chunks of ~300-500 characters
-            if current_length >= 300:
-                result.append(' '.join(current_chunk))
-                current_chunk = []
-                current_length = 0
+            if match.start() - chunk_start >= 300:
+                result.append(text[chunk_start:match.start()])
+                chunk_start = match.end()
         
         # Don't forget the last chunk
-        if current_chunk:
-            result.append(' '.join(current_chunk))
+        if chunk_start < len(text):
+            result.append(text[chunk_start:])
     
     return result if result else [text]
 
 
-def audio_to_wav_bytes(audio_tensor, sample_rate: int) -> bytes:
-    """Convert audio tensor to WAV bytes."""
-    audio_np = audio_tensor.numpy()
-    # Normalize to int16
-    audio_int16 = (audio_np * 32767).astype(np.int16)
+@lru_cache(maxsize=8)
+def stream_wav_header(sample_rate: int, nchannels: int = 1, sampwidth: int = 2) -> bytes:
+    """
+    WAV header for an indefinite-length stream, which browsers accept for
+    progressive playback. Cached, as the sample rate is fixed for a loaded model.
+    """
+    return wav_header(sample_rate, nchannels, sampwidth)
+
+
+def wav_header(sample_rate: int, nchannels: int = 1, sampwidth: int = 2,
+               data_size: int = 0xFFFFFFFF) -> bytes:
+    """
+    Build a 44-byte PCM WAV header.
+
+    The default data size of 0xFFFFFFFF marks an indefinite-length stream.
+    """
+    block_align = nchannels * sampwidth
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', min(36 + data_size, 0xFFFFFFFF), b'WAVE',
+        b'fmt ', 16, 1, nchannels, sample_rate, sample_rate * block_align,
+        block_align, sampwidth * 8,
+        b'data', data_size,
+    )
+
+
+def audio_to_pcm16(audio_tensor) -> bytes:
+    """Convert an audio tensor to little-endian 16-bit PCM bytes."""
+    audio_np = np.ascontiguousarray(audio_tensor.numpy(), dtype=np.float32)
+    # Scale in float32 (a Python int would upcast to float64) into a fresh
+    # buffer, since the array may share memory with the tensor
+    scaled = np.multiply(audio_np, np.float32(32767.0))
+    np.clip(scaled, -32768, 32767, out=scaled)
+    return scaled.astype('<i2', copy=False).tobytes()
+
+
+def _send_audio(result_queue, request_id: int, audio):
+    """Reply with a chunk of audio as PCM16 in shared memory, so it isn't pickled."""
+    pcm = audio_to_pcm16(audio)
+    if not pcm:
+        return
+    shm = SharedMemory(create=True, size=len(pcm))
+    shm.buf[:len(pcm)] = pcm
+    result_queue.put((request_id, 'chunk', (shm.name, len(pcm))))
+    # The receiving process unlinks the segment once it has copied it
+    shm.close()
+
+
+def _generate_batch(model, voice: str, items: list, result_queue):
+    """
+    Synthesize a batch of same-voice (request_id, text) items.
+    
+    Replies with audio chunks as they are generated, then marks each request
+    done. Batched requests only get their audio once the whole batch is done.
+    """
+    # pocket-tts already runs generation under torch.no_grad. Don't wrap these
+    # calls in torch.inference_mode: the state copies made here would become
+    # inference tensors, which pocket-tts's generation thread then fails to
+    # update in place.
+    try:
+        voice_state = get_voice_state(voice)
+        generate_batch = getattr(model, 'generate_audio_batch', None)
+        if generate_batch is not None and len(items) > 1:
+            texts = [text for _, text in items]
+            audios = generate_batch([voice_state] * len(items), texts)
+            for (request_id, _), audio in zip(items, audios):
+                _send_audio(result_queue, request_id, audio)
+                result_queue.put((request_id, 'done', None))
+            return
+    except Exception as e:
+        for request_id, _ in items:
+            result_queue.put((request_id, 'error', str(e)))
+        return
+    
+    # Run the requests one after another, streaming when the model can
+    generate_stream = getattr(model, 'generate_audio_stream', None)
+    for request_id, text in items:
+        try:
+            if generate_stream is not None:
+                for audio in generate_stream(voice_state, text):
+                    _send_audio(result_queue, request_id, audio)
+            else:
+                _send_audio(result_queue, request_id, model.generate_audio(voice_state, text))
+            result_queue.put((request_id, 'done', None))
+        except Exception as e:
+            result_queue.put((request_id, 'error', str(e)))
+
+
+def _model_worker(request_queue, result_queue):
+    """
+    Entry point of the model worker process.
+    
+    Owns the model and runs every model call, batching synthesis requests
+    per voice, so the Flask threads only do I/O.
+    """
+    try:
+        model = get_model()
+    except Exception as e:
+        result_queue.put((None, 'failed', str(e)))
+        return
+    
+    # Run one short synthesis so the first real request doesn't pay for
+    # allocator and kernel warmup
+    try:
+        model.generate_audio(get_voice_state('alba'), "Hello.")
+    except Exception as e:
+        log.warning("Warmup synthesis failed: %s", e)
+    result_queue.put((None, 'ready', model.sample_rate))
+    
+    while True:
+        pending = [request_queue.get()]
+        if hasattr(model, 'generate_audio_batch'):
+            # Give concurrent requests a moment to join the batch
+            time.sleep(BATCH_WAIT_SECONDS)
+        try:
+            while True:
+                pending.append(request_queue.get_nowait())
+        except queue.Empty:
+            pass
+        
+        by_voice = {}
+        for request_id, kind, payload in pending:
+            if kind == 'preload':
+                try:
+                    for voice in payload:
+                        get_voice_state(voice)
+                    result_queue.put((request_id, 'done', None))
+                except Exception as e:
+                    result_queue.put((request_id, 'error', str(e)))
+            else:
+                text, voice = payload
+                by_voice.setdefault(voice, []).append((request_id, text))
+        
+        for voice, items in by_voice.items():
+            _generate_batch(model, voice, items, result_queue)
+
+
+def _read_shared_pcm(name: str, size: int) -> bytes:
+    """Copy PCM16 audio out of a shared memory segment and release it."""
+    shm = SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _collect_results(process, result_queue):
+    """
+    Hand replies from the model worker process to the requests waiting for them.
+    
+    Each request's reply queue gets its audio chunks, then None once it is
+    done, or an exception if it failed.
+    """
+    global _worker_error, _sample_rate
+    while True:
+        try:
+            request_id, status, payload = result_queue.get(timeout=1.0)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            request_id, status, payload = None, 'failed', "Model worker exited"
+        
+        if request_id is None:
+            if status == 'ready':
+                _sample_rate = payload
+                _worker_ready.set()
+                continue
+            _worker_error = payload
+            _worker_ready.set()
+            _fail_pending_requests(process, RuntimeError(payload))
+            return
+        
+        try:
+            if status == 'chunk':
+                # Always release the segment, even if nobody waits for it anymore
+                reply = _read_shared_pcm(*payload)
+            elif status == 'error':
+                reply = RuntimeError(payload)
+            else:
+                reply = None
+        except Exception as e:
+            # Fail only this request, the collector has to keep running
+            log.error("Failed to read reply from model worker: %s", e)
+            status, reply = 'error', RuntimeError(f"Failed to read audio: {e}")
+        with _worker_lock:
+            if status == 'chunk':
+                replies = _pending_requests.get(request_id)
+            else:
+                replies = _pending_requests.pop(request_id, None)
+        if replies is not None:
+            replies.put(reply)
+
+
+def _fail_pending_requests(process, error: Exception):
+    """Fail every unanswered request so the next one restarts the worker."""
+    global _worker_process
+    with _worker_lock:
+        if _worker_process is not process:
+            return
+        pending = list(_pending_requests.values())
+        _pending_requests.clear()
+        _worker_process = None
+    for replies in pending:
+        replies.put(error)
+
+
+def _start_worker():
+    """Start the model worker process unless it is running. Needs _worker_lock."""
+    global _worker_process, _request_queue, _worker_error
+    if _worker_process is not None:
+        return
+    # Spawn rather than fork, so the child doesn't inherit server threads
+    ctx = mp.get_context('spawn')
+    _request_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    _worker_ready.clear()
+    _worker_error = None
+    _worker_process = ctx.Process(
+        target=_model_worker, args=(_request_queue, result_queue), daemon=True
+    )
+    _worker_process.start()
+    threading.Thread(
+        target=_collect_results, args=(_worker_process, result_queue), daemon=True
+    ).start()
+
+
+def _submit(kind: str, payload) -> queue.SimpleQueue:
+    """Send a request to the model worker process, starting it if needed."""
+    replies = queue.SimpleQueue()
+    with _worker_lock:
+        _start_worker()
+        request_id = next(_request_ids)
+        _pending_requests[request_id] = replies
+        _request_queue.put((request_id, kind, payload))
+    return replies
+
+
+def next_reply(replies: queue.SimpleQueue):
+    """Wait for the next reply to a request, raising it if it is an error."""
+    try:
+        reply = replies.get(timeout=WORKER_REPLY_TIMEOUT_SECONDS)
+    except queue.Empty:
+        raise TimeoutError("Model worker did not reply in time") from None
+    if isinstance(reply, Exception):
+        raise reply
+    return reply
+
+
+def get_sample_rate() -> int:
+    """
+    Sample rate of the model, starting the model worker process if needed.
+    
+    Waits up to WORKER_START_TIMEOUT_SECONDS for the model to load, so call it
+    before submitting work: replies only get WORKER_REPLY_TIMEOUT_SECONDS.
+    """
+    with _worker_lock:
+        _start_worker()
+    if not _worker_ready.wait(WORKER_START_TIMEOUT_SECONDS):
+        raise TimeoutError("Model worker did not start in time")
+    if _worker_error is not None:
+        raise RuntimeError(_worker_error)
+    return _sample_rate
+
+
+def submit_synthesis(text: str, voice: str) -> queue.SimpleQueue:
+    """Queue text for synthesis, returning the queue its PCM16 chunks arrive on."""
+    return _submit('synthesize', (text, voice))
+
+
+def submit_preload(voices: list[str]) -> queue.SimpleQueue:
+    """Queue voices to load in the model worker, returning the queue for its reply."""
+    return _submit('preload', voices)
+
+
+def synthesize_chunks(text: str, voice: str):
+    """
+    Start synthesizing text, returning a generator of PCM16 chunks and the total size.
+    
+    Audio synthesized recently for the same voice and text comes back as one
+    chunk of known size. Otherwise the size is None and chunks are yielded as
+    the model worker produces them. Waits for the first chunk, so failures are
+    raised here rather than in the middle of a response.
+    """
+    key = hashlib.blake2b(f"{voice}|{text}".encode(), digest_size=16).digest()
+    with _audio_cache_lock:
+        pcm = _audio_cache.get(key)
+        if pcm is not None:
+            _audio_cache.move_to_end(key)
+    if pcm is not None:
+        return _yield_cached(pcm), len(pcm)
+    
+    replies = submit_synthesis(text, voice)
+    first = next_reply(replies)
+    return _yield_replies(key, replies, first), None
+
+
+def _yield_cached(pcm: bytes):
+    """Yield cached audio as a single chunk."""
+    yield pcm
+
+
+def _yield_replies(key: bytes, replies: queue.SimpleQueue, chunk):
+    """Yield PCM16 chunks from a synthesis request, caching the audio once complete."""
+    chunks = []
+    try:
+        while chunk is not None:
+            chunks.append(chunk)
+            yield chunk
+            chunk = next_reply(replies)
+    except Exception as e:
+        log.error("Error generating speech: %s", e)
+        return
+    _cache_audio(key, b''.join(chunks))
+
+
+def _cache_audio(key: bytes, pcm: bytes):
+    """Store synthesized audio, evicting the least recently used beyond the limits."""
+    global _audio_cache_bytes
+    with _audio_cache_lock:
+        if key not in _audio_cache:
+            _audio_cache[key] = pcm
+            _audio_cache_bytes += len(pcm)
+            while (len(_audio_cache) > AUDIO_CACHE_MAX_ENTRIES
+                   or _audio_cache_bytes > AUDIO_CACHE_MAX_BYTES):
+                _, evicted = _audio_cache.popitem(last=False)
+                _audio_cache_bytes -= len(evicted)
+
+
+def probe_encoded_formats() -> set[str]:
+    """Find the compressed formats whose encoder the installed ffmpeg has."""
+    if FFMPEG_PATH is None:
+        log.info("ffmpeg not found, audio is only available as WAV")
+        return set()
+    try:
+        result = subprocess.run(
+            [FFMPEG_PATH, '-hide_banner', '-encoders'],
+            capture_output=True, text=True, timeout=10,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        log.warning("Could not list ffmpeg encoders: %s", e)
+        return set()
+    
+    encoders = set(result.stdout.split())
+    formats = set()
+    for audio_format, (codec_args, _) in ENCODED_FORMATS.items():
+        encoder = codec_args[codec_args.index('-c:a') + 1]
+        if encoder in encoders:
+            formats.add(audio_format)
+        else:
+            log.warning("ffmpeg has no %s encoder, %s output is unavailable",
+                        encoder, audio_format)
+    return formats
+
+
+def encoded_response(pcm_chunks, sample_rate: int, audio_format: str) -> Response:
+    """
+    Pipe PCM16 chunks through ffmpeg, streaming encoded bytes as they come out.
+    
+    ffmpeg is started before the response is built, so a failure to launch it
+    still turns into an error response.
+    """
+    codec_args, mimetype = ENCODED_FORMATS[audio_format]
+    process = subprocess.Popen(
+        [FFMPEG_PATH, '-loglevel', 'error',
+         '-f', 's16le', '-ar', str(sample_rate), '-ac', '1', '-i', '-',
+         *codec_args, '-'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    finished = threading.Event()
+    
+    def feed():
+        # Runs in its own thread so ffmpeg's stdin and stdout never deadlock
+        try:
+            for pcm in pcm_chunks:
+                process.stdin.write(pcm)
+        except (BrokenPipeError, ValueError):
+            pass  # ffmpeg was stopped because the client went away
+        finally:
+            pcm_chunks.close()
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+    
+    def generate():
+        while True:
+            data = process.stdout.read1(65536)
+            if not data:
+                break
+            yield data
+        finished.set()
+    
+    def stop():
+        # Runs when the response is closed, even if it was never iterated
+        if not finished.is_set() and process.poll() is None:
+            process.kill()  # The client went away before ffmpeg was done
+        process.wait()
+        if process.returncode > 0:
+            error = process.stderr.read().decode(errors='replace').strip()
+            log.error("ffmpeg exited with status %d: %s", process.returncode, error)
+        process.stdout.close()
+        process.stderr.close()
+    
+    threading.Thread(target=feed, daemon=True).start()
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.call_on_close(stop)
+    return response
+
+
+def audio_response(pcm_chunks, sample_rate: int, audio_format: str,
+                   data_size: int | None = None) -> Response:
+    """
+    Wrap a generator of PCM16 chunks in a streaming response of the given format.
     
-    # Create WAV file in memory
-    buffer = io.BytesIO()
-    with wave.open(buffer, 'wb') as wav_file:
-        wav_file.setnchannels(1)
-        wav_file.setsampwidth(2)  # 16-bit
-        wav_file.setframerate(sample_rate)
-        wav_file.writeframes(audio_int16.tobytes())
+    WAV headers carry data_size when the total size is known, so players can
+    tell the duration; otherwise they mark an indefinite-length stream.
+    """
+    if audio_format in ENCODED_FORMATS:
+        return encoded_response(pcm_chunks, sample_rate, audio_format)
+    
+    def generate():
+        if data_size is None:
+            yield stream_wav_header(sample_rate)
+        else:
+            yield wav_header(sample_rate, data_size=data_size)
+        yield from pcm_chunks
+    
+    return Response(stream_with_context(generate()), mimetype='audio/wav')
+
+
+def _put_unless_stopped(audio_queue: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put an item on a bounded queue, giving up once stop is set."""
+    while not stop.is_set():
+        try:
+            audio_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def produce_paragraph_audio(voice: str, paragraphs: list[str],
+                            audio_queue: queue.Queue, stop: threading.Event):
+    """
+    Synthesize paragraphs in order, feeding a generator of each one's PCM16 chunks into the queue.
     
-    buffer.seek(0)
-    return buffer.read()
+    The queue is bounded, so synthesis only runs a few paragraphs ahead of the
+    client. Finishes by putting None on the queue to mark the end of the
+    stream, unless the client went away.
+    """
+    try:
+        for paragraph in paragraphs:
+            if stop.is_set():
+                return
+            chunks, _ = synthesize_chunks(paragraph, voice)
+            if not _put_unless_stopped(audio_queue, chunks, stop):
+                chunks.close()
+                return
+    except Exception as e:
+        log.error("Error generating speech: %s", e)
+    finally:
+        _put_unless_stopped(audio_queue, None, stop)
+
+
+def json_response(data, status: int = 200) -> Response:
+    """Serialize data to a JSON response with orjson."""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+
+def read_json():
+    """
+    Parse the JSON request body, or return None if it isn't a JSON object.
+    
+    Reads the body without caching it on the request, so large texts are only
+    held once, and parses it with orjson.
+    """
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Report bodies over MAX_CONTENT_LENGTH as JSON, like every other error."""
+    limit = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return json_response({"error": f"Request body is larger than {limit} MiB"}, 413)
+
+
+@app.before_request
+def cors_preflight():
+    """Answer CORS preflight requests for the extension directly."""
+    if request.method == 'OPTIONS':
+        return Response(status=204, headers={
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            # Let browsers reuse the preflight result for a day
+            'Access-Control-Max-Age': '86400',
+        })
+
+
+@app.after_request
+def add_cors_headers(response):
+    """Enable CORS for the extension, letting it read the raw PCM stream format."""
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Expose-Headers'] = 'X-Sample-Rate, X-Channels'
+    return response
 
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
-    return jsonify({"status": "ok"})
+    return json_response({"status": "ok"})
 
 
 @app.route('/voices', methods=['GET'])
 def list_voices():
     """List available voices."""
-    return jsonify({
+    return json_response({
         "voices": AVAILABLE_VOICES,
         "default": "alba"
     })
@@ -132,18 +789,18 @@ def get_paragraphs():
         "count": 2
     }
     """
-    data = request.get_json()
+    data = read_json()
     
-    if not data or 'text' not in data:
-        return jsonify({"error": "Missing 'text' field"}), 400
+    if not data or not isinstance(data.get('text'), str):
+        return json_response({"error": "Missing or non-string 'text' field"}, 400)
     
     text = data['text']
     if not text.strip():
-        return jsonify({"error": "Text cannot be empty"}), 400
+        return json_response({"error": "Text cannot be empty"}, 400)
     
     paragraphs = split_into_paragraphs(text)
     
-    return jsonify({
+    return json_response({
         "paragraphs": paragraphs,
         "count": len(paragraphs)
     })
@@ -154,47 +811,160 @@ def synthesize():
     """
     Synthesize text to speech.
     
+    Audio for a voice and text that was synthesized recently is served from
+    memory.
+    
+    Request body:
+    {
+        "text": "Text to synthesize",
+        "voice": "alba",  # optional, defaults to "alba"
+        "format": "wav"   # optional, "wav", "opus" or "mp3"
+    }
+    
+    Returns: audio in the requested format, streamed as it is generated
+    """
+    data = read_json()
+    
+    if not data or not isinstance(data.get('text'), str):
+        return json_response({"error": "Missing or non-string 'text' field"}, 400)
+    
+    text = data['text']
+    voice = data.get('voice', 'alba')
+    audio_format = data.get('format', 'wav')
+    
+    if not text.strip():
+        return json_response({"error": "Text cannot be empty"}, 400)
+    
+    if voice not in AVAILABLE_VOICES:
+        voice = 'alba'
+    
+    if audio_format not in _encoded_formats:
+        audio_format = 'wav'
+    
+    try:
+        log.info("Generating speech for: %s...", text[:50])
+        sample_rate = get_sample_rate()
+        chunks, data_size = synthesize_chunks(text, voice)
+        return audio_response(chunks, sample_rate, audio_format, data_size)
+    except Exception as e:
+        log.error("Error generating speech: %s", e)
+        return json_response({"error": str(e)}, 500)
+
+
+@app.route('/synthesize_pcm', methods=['POST'])
+def synthesize_pcm_route():
+    """
+    Synthesize text to raw audio samples, without a container.
+    
+    Meant for players that feed samples straight to Web Audio. The samples
+    are mono little-endian 16-bit PCM, with the sample rate and channel count
+    in the X-Sample-Rate and X-Channels response headers.
+    
     Request body:
     {
         "text": "Text to synthesize",
         "voice": "alba"  # optional, defaults to "alba"
     }
     
-    Returns: WAV audio file
+    Returns: PCM audio, streamed as it is generated
     """
-    data = request.get_json()
+    data = read_json()
     
-    if not data or 'text' not in data:
-        return jsonify({"error": "Missing 'text' field"}), 400
+    if not data or not isinstance(data.get('text'), str):
+        return json_response({"error": "Missing or non-string 'text' field"}, 400)
     
     text = data['text']
     voice = data.get('voice', 'alba')
     
     if not text.strip():
-        return jsonify({"error": "Text cannot be empty"}), 400
+        return json_response({"error": "Text cannot be empty"}, 400)
     
     if voice not in AVAILABLE_VOICES:
         voice = 'alba'
     
     try:
-        model = get_model()
-        voice_state = get_voice_state(voice)
-        
-        print(f"Generating speech for: {text[:50]}...")
-        audio = model.generate_audio(voice_state, text)
-        
-        wav_bytes = audio_to_wav_bytes(audio, model.sample_rate)
-        
-        return Response(
-            wav_bytes,
-            mimetype='audio/wav',
-            headers={
-                'Content-Disposition': 'attachment; filename=speech.wav'
-            }
-        )
+        log.info("Generating speech for: %s...", text[:50])
+        sample_rate = get_sample_rate()
+        chunks, data_size = synthesize_chunks(text, voice)
+        headers = {
+            'X-Sample-Rate': str(sample_rate),
+            'X-Channels': '1',
+        }
+        if data_size is not None:
+            headers['Content-Length'] = str(data_size)
+        return Response(stream_with_context(chunks), mimetype='audio/pcm', headers=headers)
+    except Exception as e:
+        log.error("Error generating speech: %s", e)
+        return json_response({"error": str(e)}, 500)
+
+
+@app.route('/synthesize_stream', methods=['POST'])
+def synthesize_stream():
+    """
+    Synthesize a full text as one audio stream, paragraph by paragraph.
+    
+    Paragraphs are synthesized in a background thread while earlier ones are
+    being sent, so only the first paragraph's latency is noticeable.
+    
+    Request body:
+    {
+        "text": "Full text to synthesize",
+        "voice": "alba",  # optional, defaults to "alba"
+        "format": "wav"   # optional, "wav", "opus" or "mp3"
+    }
+    
+    Returns: audio in the requested format, streamed as it is generated
+    """
+    data = read_json()
+    
+    if not data or not isinstance(data.get('text'), str):
+        return json_response({"error": "Missing or non-string 'text' field"}, 400)
+    
+    text = data['text']
+    voice = data.get('voice', 'alba')
+    audio_format = data.get('format', 'wav')
+    
+    if not text.strip():
+        return json_response({"error": "Text cannot be empty"}, 400)
+    
+    if voice not in AVAILABLE_VOICES:
+        voice = 'alba'
+    
+    if audio_format not in _encoded_formats:
+        audio_format = 'wav'
+    
+    try:
+        sample_rate = get_sample_rate()
     except Exception as e:
-        print(f"Error generating speech: {e}")
-        return jsonify({"error": str(e)}), 500
+        log.error("Error generating speech: %s", e)
+        return json_response({"error": str(e)}, 500)
+    
+    paragraphs = split_into_paragraphs(text)
+    audio_queue = queue.Queue(maxsize=STREAM_PARAGRAPHS_AHEAD)
+    stop = threading.Event()
+    
+    def pcm_chunks():
+        # Poll, since the producer skips the end marker once stop is set
+        while not stop.is_set():
+            try:
+                chunks = audio_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if chunks is None:
+                break
+            yield from chunks
+    
+    log.info("Generating speech for %d paragraphs...", len(paragraphs))
+    threading.Thread(
+        target=produce_paragraph_audio,
+        args=(voice, paragraphs, audio_queue, stop),
+        daemon=True,
+    ).start()
+    response = audio_response(pcm_chunks(), sample_rate, audio_format)
+    # Stop the producer once the response is closed, even if the client
+    # disconnected before the body was read
+    response.call_on_close(stop.set)
+    return response
 
 
 @app.route('/preload', methods=['POST'])
@@ -202,48 +972,66 @@ def preload():
     """
     Preload model and voices for faster first synthesis.
     
+    Only the last MAX_LOADED_VOICES voices stay loaded.
+    
     Request body:
     {
         "voices": ["alba", "jean"]  # optional, list of voices to preload
     }
     """
-    data = request.get_json() or {}
+    data = read_json() or {}
     voices_to_load = data.get('voices', ['alba'])
     
     try:
-        # Load model
-        get_model()
-        
-        # Load specified voices
-        for voice in voices_to_load:
-            if voice in AVAILABLE_VOICES:
-                get_voice_state(voice)
+        # Load model and specified voices in the model worker
+        loaded_voices = [v for v in voices_to_load if v in AVAILABLE_VOICES]
+        get_sample_rate()
+        next_reply(submit_preload(loaded_voices))
         
-        return jsonify({
+        return json_response({
             "status": "ok",
-            "loaded_voices": [v for v in voices_to_load if v in AVAILABLE_VOICES]
+            "loaded_voices": loaded_voices
         })
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
+
+
+def start_background_work():
+    """
+    Probe ffmpeg's encoders and start loading the model in the worker process.
+    
+    Called from main() and from Gunicorn's post_worker_init hook
+    (gunicorn.conf.py) rather than at import, since the spawned model worker
+    imports this module too.
+    """
+    _encoded_formats.update(probe_encoded_formats())
+    with _worker_lock:
+        _start_worker()
 
 
 def main():
     """Main entry point for the server."""
-    print("Starting Pocket Reader TTS Server...")
-    print("Available voices:", AVAILABLE_VOICES)
-    print("\nEndpoints:")
-    print("  GET  /health      - Health check")
-    print("  GET  /voices      - List available voices")
-    print("  POST /paragraphs  - Split text into paragraphs")
-    print("  POST /synthesize  - Convert text to speech")
-    print("  POST /preload     - Preload model and voices")
-    print("\nServer running at http://localhost:5050")
+    log.info("Starting Pocket Reader TTS Server...")
+    log.info("Available voices: %s", AVAILABLE_VOICES)
+    log.info("\nEndpoints:")
+    log.info("  GET  /health      - Health check")
+    log.info("  GET  /voices      - List available voices")
+    log.info("  POST /paragraphs  - Split text into paragraphs")
+    log.info("  POST /synthesize  - Convert text to speech")
+    log.info("  POST /synthesize_pcm - Convert text to raw PCM samples")
+    log.info("  POST /synthesize_stream - Convert a full text to one audio stream")
+    log.info("  POST /preload     - Preload model and voices")
+    log.info("\nServer running at http://localhost:5050")
+    
+    start_background_work()
     
     # Preload the model on startup
-    get_model()
-    get_voice_state('alba')
+    get_sample_rate()
+    next_reply(submit_preload(['alba']))
     
-    app.run(host='0.0.0.0', port=5050, debug=False)
+    # Development server; for production run gunicorn server:app, which
+    # picks up gunicorn.conf.py
+    app.run(host='0.0.0.0', port=5050, debug=False, threaded=True)
 
 
 if __name__ == '__main__':